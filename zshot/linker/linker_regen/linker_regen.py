@@ -1,4 +1,8 @@
-from typing import Iterator, Optional, Union, List
+import os
+import pkgutil
+import shutil
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 import torch
 from spacy.tokens import Doc
@@ -7,26 +11,37 @@ from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 from zshot.config import MODELS_CACHE_PATH
 from zshot.linker.linker import Linker
 from zshot.linker.linker_regen.trie import Trie
-from zshot.linker.linker_regen.utils import create_input
+from zshot.linker.linker_regen.utils import create_input, left_context_start, right_context_end
 from zshot.utils.data_models import Entity, Span
 
 MODEL_NAME = "ibm/regen-disambiguation"
+ONNX_MODEL_DIR = "regen-disambiguation-onnx"
 
 START_ENT_TOKEN = "[START_ENT]"
 END_ENT_TOKEN = "[END_ENT]"
 
+DEFAULT_BATCH_SIZE = 8
+
 
 class LinkerRegen(Linker):
     """ REGEN linker """
-    def __init__(self, max_input_len=384, max_output_len=15, num_beams=10, trie=None):
+    def __init__(self, max_input_len=384, max_output_len=15, num_beams=10, trie=None, quantize=False,
+                 use_onnx=False):
         """
         :param max_input_len: Max length of input
         :param max_output_len: Max length of output
         :param num_beams: Number of beans to use
         :param trie: If the trie is given the linker will use it to restrict the search space.
         Custom entities won't be used if the trie is given.
+        :param quantize: If True the Linear layers of the model are dynamically quantized to int8 for faster
+        CPU inference. Only the PyTorch CPU model is quantized, the flag has no effect when use_onnx is True.
+        :param use_onnx: If True the model is exported to ONNX and run with ONNX Runtime. Quantization is not applied.
+        The export is cached in MODELS_CACHE_PATH and it is not serialized by to_disk, it is loaded again instead.
         """
         super().__init__()
+        if use_onnx and not (pkgutil.find_loader("optimum") and pkgutil.find_loader("onnxruntime")):
+            raise Exception("Optimum ONNX Runtime backend not installed. You need to install Optimum and ONNX Runtime "
+                            "for using ONNX Runtime. Install it with: pip install optimum[onnxruntime]")
         self.model = None
         self.tokenizer = None
         self.max_input_len = max_input_len
@@ -34,6 +49,9 @@ class LinkerRegen(Linker):
         self.num_beams = num_beams
         self.skip_set_kg = False if trie is None else True
         self.trie = trie
+        self.quantize = quantize
+        self.use_onnx = use_onnx
+        self._trie_nodes: Dict[Tuple[int, ...], Optional[dict]] = {}
 
     def set_kg(self, entities: Iterator[Entity]):
         """ Set new entities
@@ -41,30 +59,75 @@ class LinkerRegen(Linker):
         :param entities: New entities to use
         """
         super().set_kg(entities)
+        self._clear_decode_cache()
         if not self.skip_set_kg:
             self.load_tokenizer()
-            self.trie = Trie(
-                [
-                    self.tokenizer(e.name, return_tensors="pt")['input_ids'][0].tolist()
-                    for e in entities
-                ]
-            )
+            names = [e.name for e in entities]
+            self.trie = Trie(self.tokenizer(names, add_special_tokens=True)['input_ids'] if names else [])
 
     def load_models(self):
         """ Load Model """
-        if self.model is None:
+        if self.model is None and self.use_onnx:
+            self.model = self._load_onnx_model()
+        elif self.model is None:
             self.model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_NAME, cache_dir=MODELS_CACHE_PATH)
+            self.model.eval()
+            if self.quantize:
+                self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
         self.load_tokenizer()
 
+    @staticmethod
+    def _load_onnx_model():
+        """ Load the ONNX export of the model, exporting it the first time """
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+        onnx_path = os.path.join(MODELS_CACHE_PATH, ONNX_MODEL_DIR)
+        if os.path.isdir(onnx_path):
+            return ORTModelForSeq2SeqLM.from_pretrained(onnx_path, use_cache=True)
+
+        model = ORTModelForSeq2SeqLM.from_pretrained(MODEL_NAME, export=True, use_cache=True,
+                                                     cache_dir=MODELS_CACHE_PATH)
+        # Save to a temporary dir first, so an interrupted export is never picked up as a finished one
+        os.makedirs(MODELS_CACHE_PATH, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=f"{ONNX_MODEL_DIR}-", dir=MODELS_CACHE_PATH)
+        try:
+            model.save_pretrained(tmp_path)
+            os.rename(tmp_path, onnx_path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(onnx_path):
+                raise
+        return model
+
+    def __getstate__(self):
+        # ONNX Runtime sessions can't be pickled, the model is loaded again on the next predict
+        state = self.__dict__.copy()
+        if self.use_onnx:
+            state['model'] = None
+        return state
+
     def load_tokenizer(self):
         """ Load Tokenizer"""
         if self.tokenizer is None:
-            self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, model_max_length=1024,
+            self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, model_max_length=1024, use_fast=True,
                                                            cache_dir=MODELS_CACHE_PATH)
 
     def restrict_decode_vocab(self, _, prefix_beam):
         """ Restrict the posibilities of the Beam search to force the text generation """
-        return self.trie.postfix(prefix_beam.tolist())
+        node = self._trie_node(tuple(prefix_beam.tolist()))
+        return [] if node is None else list(node.keys())
+
+    def _clear_decode_cache(self):
+        """ Drop the prefix lookups cached while decoding """
+        self._trie_nodes = {}
+
+    def _trie_node(self, prefix: Tuple[int, ...]) -> Optional[dict]:
+        """ Get the trie node reached by a decoded prefix, stepping from the node of its parent prefix """
+        if len(prefix) <= 1:
+            return self.trie.trie_dict
+        if prefix not in self._trie_nodes:
+            parent = self._trie_node(prefix[:-1])
+            self._trie_nodes[prefix] = None if parent is None else parent.get(prefix[-1])
+        return self._trie_nodes[prefix]
 
     def predict(self, docs: Iterator[Doc], batch_size: Optional[Union[int, None]] = None) -> List[List[Span]]:
         """
@@ -75,63 +138,66 @@ class LinkerRegen(Linker):
         """
         self.load_models()
         data_to_link = []
-        docs = list(docs)
+        sentences = []
+        docs_pred = []
         for doc_id, doc in enumerate(docs):
-            for mention_id, mention in enumerate(doc._.mentions):
-                left_context = doc.text[:mention.start]
-                right_context = doc.text[mention.end:]
-                text = doc.text[mention.start:mention.end]
-                sentence = f"{left_context} {START_ENT_TOKEN} {text} {END_ENT_TOKEN} {right_context}"
-                data_to_link.append(
-                    {
-                        "id": doc_id,
-                        "mention_id": mention_id,
-                        "text": sentence,
-                    })
-
-        sentences = [create_input(d['text'],
-                                  max_length=self.max_input_len,
-                                  start_delimiter=START_ENT_TOKEN,
-                                  end_delimiter=END_ENT_TOKEN,
-                                  ) for d in data_to_link]
+            docs_pred.append([])
+            doc_text = doc.text
+            for mention in doc._.mentions:
+                # create_input keeps at most max_input_len words, so farther context is never used
+                left_start = left_context_start(doc_text, mention.start, self.max_input_len)
+                right_end = right_context_end(doc_text, mention.end, self.max_input_len)
+                sentence = " ".join([doc_text[left_start:mention.start], START_ENT_TOKEN,
+                                     doc_text[mention.start:mention.end], END_ENT_TOKEN,
+                                     doc_text[mention.end:right_end]])
+                data_to_link.append((doc_id, mention.start, mention.end))
+                sentences.append(create_input(sentence,
+                                              max_length=self.max_input_len,
+                                              start_delimiter=START_ENT_TOKEN,
+                                              end_delimiter=END_ENT_TOKEN,
+                                              ))
         if not sentences:
-            return []
-
-        sequences = []
-        scores = []
-        for sent in sentences:
-            input_args = {
-                k: v
-                for k, v in self.tokenizer.batch_encode_plus(
-                    [sent], padding=True, return_tensors="pt"
-                ).items()
-            }
-
-            outputs = self.model.generate(
-                **input_args,
-                min_length=0,
-                max_length=self.max_output_len,
-                num_beams=self.num_beams,
-                num_return_sequences=min(self.num_beams, len(self.entities)) if self.entities else self.num_beams,
-                output_scores=True,
-                return_dict_in_generate=True,
-                prefix_allowed_tokens_fn=None
-                if self.trie is None
-                else self.restrict_decode_vocab,
-            )
-
-            tmp_scores = torch.nn.Softmax()(outputs.sequences_scores)
-            sequences.append(outputs.sequences[torch.argmax(tmp_scores)])
-            scores.append(max(tmp_scores.cpu().numpy().tolist()))
-
-        docs_pred = {}
-        for data, out, score in zip(data_to_link, sequences, scores):
-            doc_id = data['id']
-            mention = docs[doc_id]._.mentions[data['mention_id']]
+            return docs_pred
+
+        batch_size = batch_size or DEFAULT_BATCH_SIZE
+
+        # Batch mentions of similar length together so that each batch is padded as little as possible
+        encodings = self.tokenizer(sentences, truncation=True)
+        order = sorted(range(len(sentences)), key=lambda idx: len(encodings['input_ids'][idx]))
+
+        sequences = [None] * len(sentences)
+        scores = [None] * len(sentences)
+        try:
+            with torch.inference_mode():
+                for i in range(0, len(order), batch_size):
+                    batch_ids = order[i:i + batch_size]
+                    input_args = self.tokenizer.pad(
+                        {k: [encodings[k][idx] for idx in batch_ids] for k in ('input_ids', 'attention_mask')},
+                        return_tensors="pt"
+                    )
+
+                    outputs = self.model.generate(
+                        **input_args,
+                        min_length=0,
+                        max_length=self.max_output_len,
+                        num_beams=self.num_beams,
+                        num_return_sequences=1,
+                        early_stopping=True,
+                        output_scores=True,
+                        return_dict_in_generate=True,
+                        prefix_allowed_tokens_fn=None
+                        if self.trie is None
+                        else self.restrict_decode_vocab,
+                    )
+
+                    for idx, sequence, score in zip(batch_ids, outputs.sequences,
+                                                    outputs.sequences_scores.exp().cpu().tolist()):
+                        sequences[idx] = sequence
+                        scores[idx] = score
+        finally:
+            self._clear_decode_cache()
+
+        for (doc_id, start, end), out, score in zip(data_to_link, sequences, scores):
             label = self.tokenizer.decode(out, skip_special_tokens=True)
-            if doc_id not in docs_pred:
-                docs_pred[doc_id] = []
-
-            docs_pred[doc_id].append(Span(mention.start, mention.end, label=label,
-                                          score=score))
-        return [val for key, val in sorted(docs_pred.items(), reverse=False)]
+            docs_pred[doc_id].append(Span(start, end, label=label, score=score))
+        return docs_pred
@@ -29,6 +29,38 @@ def create_input(sentence, max_length, start_delimiter, end_delimiter):
         return " ".join(sent_list[left_index:right_index])
 
 
+def left_context_start(text: str, start: int, max_words: int) -> int:
+    """
+    Find where the left context of a mention should start, keeping at most `max_words` words
+    :param text: Text of the document
+    :param start: Start char idx of the mention
+    :param max_words: Max number of space separated words to keep
+    :return: Char idx where the left context starts
+    """
+    idx = start
+    for _ in range(max_words):
+        idx = text.rfind(" ", 0, idx)
+        if idx == -1:
+            return 0
+    return idx + 1
+
+
+def right_context_end(text: str, end: int, max_words: int) -> int:
+    """
+    Find where the right context of a mention should end, keeping at most `max_words` words
+    :param text: Text of the document
+    :param end: End char idx of the mention
+    :param max_words: Max number of space separated words to keep
+    :return: Char idx where the right context ends
+    """
+    idx = end - 1
+    for _ in range(max_words):
+        idx = text.find(" ", idx + 1)
+        if idx == -1:
+            return len(text)
+    return idx
+
+
 def load_wikipedia_trie() -> Trie:  # pragma: no cover
     """
     Load the wikipedia trie from the HB hub
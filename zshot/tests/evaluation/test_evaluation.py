@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import Iterator, List, Tuple
 
 import spacy
@@ -36,13 +37,15 @@ class DummyLinker(Linker):
     def predict(self, docs: Iterator[Doc], batch_size=None):
         sentences = []
         for doc in docs:
+            text = doc.text
             preds = []
             for span, label, score in self.predictions:
-                if span in doc.text:
+                start = text.find(span)
+                if start != -1:
                     preds.append(
                         Span(
-                            doc.text.find(span),
-                            doc.text.find(span) + len(span),
+                            start,
+                            start + len(span),
                             label=label,
                             score=score,
                         )
@@ -81,13 +84,15 @@ class DummyMentionsExtractor(MentionsExtractor):
     def predict(self, docs: Iterator[Doc], batch_size=None):
         sentences = []
         for doc in docs:
+            text = doc.text
             preds = []
             for span, label, score in self.predictions:
-                if span in doc.text:
+                start = text.find(span)
+                if start != -1:
                     preds.append(
                         Span(
-                            doc.text.find(span),
-                            doc.text.find(span) + len(span),
+                            start,
+                            start + len(span),
                             label="MENTION",
                             score=score,
                         )
@@ -141,9 +146,14 @@ def get_spans_predictions(span: str, label: str, sentence: str):
 
 
 def get_dataset(gt: List[List[str]], sentence: List[str]):
+    return _get_cached_dataset(tuple(map(tuple, gt)), tuple(sentence))
+
+
+@lru_cache(maxsize=None)
+def _get_cached_dataset(gt: Tuple[Tuple[str, ...], ...], sentence: Tuple[str, ...]):
     data_dict = {
         "tokens": [s.split(" ") for s in sentence],
-        "ner_tags": gt,
+        "ner_tags": [list(tags) for tags in gt],
     }
     dataset = Dataset.from_dict(data_dict)
     dataset.entities = ENTITIES
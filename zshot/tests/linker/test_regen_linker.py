@@ -1,16 +1,20 @@
 import gc
 import logging
+import pickle
 import shutil
 from pathlib import Path
+from types import SimpleNamespace
 
 import pytest
 import spacy
+import torch
+from spacy.tokens import Doc
 
 from zshot import PipelineConfig
-from zshot.linker.linker_regen.linker_regen import LinkerRegen
+from zshot.linker.linker_regen.linker_regen import LinkerRegen, START_ENT_TOKEN, END_ENT_TOKEN
 from zshot.linker.linker_regen.trie import Trie
 from zshot.linker.linker_regen.utils import load_wikipedia_trie, spans_to_wikipedia, \
-    load_dbpedia_trie, spans_to_dbpedia, create_input
+    load_dbpedia_trie, spans_to_dbpedia, create_input, left_context_start, right_context_end
 from zshot.tests.config import EX_DOCS, EX_ENTITIES
 from zshot.tests.mentions_extractor.test_mention_extractor import DummyMentionsExtractor
 from zshot.utils.data_models import Span
@@ -28,6 +32,69 @@ def teardown():
     gc.collect()
 
 
+class DummyRegenTokenizer:
+    """ Whitespace tokenizer that builds its vocabulary on the fly """
+    def __init__(self):
+        self.vocab = {"<pad>": 0}
+        self.words = ["<pad>"]
+
+    def token_id(self, word):
+        if word not in self.vocab:
+            self.vocab[word] = len(self.words)
+            self.words.append(word)
+        return self.vocab[word]
+
+    def __call__(self, sentences, truncation=True):
+        input_ids = [[self.token_id(w) for w in s.split(" ")] for s in sentences]
+        return {"input_ids": input_ids, "attention_mask": [[1] * len(ids) for ids in input_ids]}
+
+    def pad(self, encodings, return_tensors="pt"):
+        max_len = max(len(ids) for ids in encodings["input_ids"])
+        return {k: torch.tensor([v + [0] * (max_len - len(v)) for v in values])
+                for k, values in encodings.items()}
+
+    def decode(self, ids, skip_special_tokens=True):
+        return " ".join(self.words[i] for i in ids.tolist() if i != 0)
+
+
+class DummyRegenModel:
+    """ Seq2seq stub that generates the mention enclosed by the entity delimiters """
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.batches = []
+
+    def generate(self, input_ids, attention_mask, **kwargs):
+        self.batches.append(input_ids.shape)
+        start_id = self.tokenizer.token_id(START_ENT_TOKEN)
+        end_id = self.tokenizer.token_id(END_ENT_TOKEN)
+        outputs = []
+        for row in input_ids.tolist():
+            outputs.append(row[row.index(start_id) + 1:row.index(end_id)])
+        max_len = max(len(out) for out in outputs)
+        return SimpleNamespace(sequences=torch.tensor([out + [0] * (max_len - len(out)) for out in outputs]),
+                               sequences_scores=torch.zeros(len(outputs)))
+
+
+def get_dummy_regen_linker():
+    linker = LinkerRegen(trie=Trie())
+    linker.tokenizer = DummyRegenTokenizer()
+    linker.model = DummyRegenModel(linker.tokenizer)
+    return linker
+
+
+def get_docs_with_mentions(texts_and_mentions):
+    for extension in ("mentions", "spans"):
+        if not Doc.has_extension(extension):
+            Doc.set_extension(extension, default=[])
+    nlp = spacy.blank("en")
+    docs = []
+    for text, mentions in texts_and_mentions:
+        doc = nlp(text)
+        doc._.mentions = [Span(text.index(m), text.index(m) + len(m)) for m in mentions]
+        docs.append(doc)
+    return docs
+
+
 def test_regen_linker():
     nlp = spacy.blank("en")
     config = PipelineConfig(
@@ -51,6 +118,27 @@ def test_regen_linker():
     del doc, nlp, config
 
 
+def test_regen_linker_quantized():
+    labels = []
+    for quantize in (False, True):
+        nlp = spacy.blank("en")
+        config = PipelineConfig(
+            mentions_extractor=DummyMentionsExtractor(),
+            linker=LinkerRegen(quantize=quantize),
+            entities=EX_ENTITIES
+        )
+        nlp.add_pipe("zshot", config=config, last=True)
+        doc = nlp(EX_DOCS[1])
+        labels.append([ent.label_ for ent in doc.ents])
+        del nlp.get_pipe('zshot').mentions_extractor, nlp.get_pipe('zshot').entities, nlp.get_pipe('zshot').nlp
+        del nlp.get_pipe('zshot').linker.tokenizer, nlp.get_pipe('zshot').linker.trie, \
+            nlp.get_pipe('zshot').linker.model, nlp.get_pipe('zshot').linker
+        nlp.remove_pipe('zshot')
+        del doc, nlp, config
+    assert len(labels[0]) > 0
+    assert labels[1] == labels[0]
+
+
 def test_regen_linker_wikification():
     nlp = spacy.blank("en")
     trie = Trie()
@@ -72,6 +160,28 @@ def test_regen_linker_wikification():
     del doc, nlp, config
 
 
+def test_regen_linker_onnx():
+    onnxruntime = pytest.importorskip("optimum.onnxruntime")
+    nlp = spacy.blank("en")
+    config = PipelineConfig(
+        mentions_extractor=DummyMentionsExtractor(),
+        linker=LinkerRegen(use_onnx=True),
+        entities=EX_ENTITIES
+    )
+    nlp.add_pipe("zshot", config=config, last=True)
+    assert "zshot" in nlp.pipe_names
+
+    doc = nlp(EX_DOCS[1])
+    assert len(doc.ents) > 0
+    assert isinstance(nlp.get_pipe('zshot').linker.model, onnxruntime.ORTModelForSeq2SeqLM)
+    assert pickle.loads(pickle.dumps(nlp.get_pipe('zshot').linker)).model is None
+    del nlp.get_pipe('zshot').mentions_extractor, nlp.get_pipe('zshot').entities, nlp.get_pipe('zshot').nlp
+    del nlp.get_pipe('zshot').linker.tokenizer, nlp.get_pipe('zshot').linker.trie, \
+        nlp.get_pipe('zshot').linker.model, nlp.get_pipe('zshot').linker
+    nlp.remove_pipe('zshot')
+    del doc, nlp, config
+
+
 @pytest.mark.skip(reason="Too expensive to run on every commit")
 def test_load_wikipedia_trie():  # pragma: no cover
     trie = load_wikipedia_trie()
@@ -113,3 +223,58 @@ def test_create_input():
     sentence = "[START]" + " test" * times_rep + " [END]"
     input_sentence = create_input(sentence, max_length, start_delimiter, end_delimiter)
     assert input_sentence == " ".join(["test" for i in range(9)])
+
+
+def test_restrict_decode_vocab_cache():
+    trie = Trie()
+    trie.add([794, 536, 1])
+    trie.add([794, 357, 1])
+    linker = LinkerRegen(trie=trie)
+    prefix = torch.tensor([2, 794])
+    assert sorted(linker.restrict_decode_vocab(0, prefix)) == [357, 536]
+    assert (2, 794) in linker._trie_nodes
+    assert sorted(linker.restrict_decode_vocab(1, prefix)) == [357, 536]
+    assert linker.restrict_decode_vocab(0, torch.tensor([2, 794, 536])) == [1]
+    assert linker.restrict_decode_vocab(0, torch.tensor([2, 100, 536])) == []
+    linker.set_kg(EX_ENTITIES)
+    assert not linker._trie_nodes
+
+
+def test_context_bounds():
+    text = "one two three four five six"
+    start, end = text.index("three"), text.index("three") + len("three")
+    assert text[left_context_start(text, start, 2):start] == "two "
+    assert text[left_context_start(text, start, 10):start] == "one two "
+    assert text[end:right_context_end(text, end, 2)] == " four"
+    assert text[end:right_context_end(text, end, 10)] == " four five six"
+
+
+def test_regen_linker_batches_restore_mention_order():
+    linker = get_dummy_regen_linker()
+    docs = get_docs_with_mentions([
+        (EX_DOCS[0], ["Domain Name System", "Internet"]),
+        ("IBM is in Armonk", ["IBM", "Armonk"]),
+        (EX_DOCS[1], ["New York"]),
+    ])
+    predictions = linker.predict(docs, batch_size=2)
+
+    assert len(linker.model.batches) == 3
+    assert [shape[1] for shape in linker.model.batches] == sorted(shape[1] for shape in linker.model.batches)
+    assert len(predictions) == len(docs)
+    for doc, spans in zip(docs, predictions):
+        assert [(s.start, s.end) for s in spans] == [(m.start, m.end) for m in doc._.mentions]
+        assert all(s.label == doc.text[s.start:s.end] for s in spans)
+
+
+def test_regen_linker_keeps_docs_without_mentions():
+    linker = get_dummy_regen_linker()
+    docs = get_docs_with_mentions([
+        ("IBM is in Armonk", ["IBM"]),
+        ("Nothing to link here", []),
+        ("Paris is nice", ["Paris"]),
+    ])
+    linker.link(docs)
+
+    assert [[s.label for s in doc._.spans] for doc in docs] == [["IBM"], [], ["Paris"]]
+    assert [[ent.text for ent in doc.ents] for doc in docs] == [["IBM"], [], ["Paris"]]
+    assert linker.predict(get_docs_with_mentions([("Nothing to link here", [])])) == [[]]